@@ -0,0 +1,188 @@
+"""
+Persistent cache of contract analysis results, keyed by contract content
+"""
+
+import copy
+import hashlib
+import heapq
+import logging
+import re
+
+import orjson
+from diskcache import Cache
+
+from contract_analysis_system import analyze_contract
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever agent prompts or models change so stale analyses are ignored
+ANALYSIS_CACHE_VERSION = 1
+CACHE_DIRECTORY = "./.analysis_cache"
+CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# Near-duplicate detection: contracts that differ only in party names, dates
+# or a few clauses share almost all of their word shingles.
+NEAR_DUPLICATE_THRESHOLD = 0.9
+SHINGLE_SIZE = 5
+SKETCH_SIZE = 256
+
+_cache = Cache(CACHE_DIRECTORY)
+
+
+def contract_hash(contract_text):
+    """Return the SHA-256 hex digest of the extracted contract text"""
+    return hashlib.sha256(contract_text.encode("utf-8")).hexdigest()
+
+
+def contract_sketch(contract_text):
+    """Return a bottom-k MinHash sketch of the contract's word shingles"""
+    words = re.findall(r"\w+", contract_text.lower())
+    shingles = {
+        " ".join(words[i : i + SHINGLE_SIZE])
+        for i in range(max(len(words) - SHINGLE_SIZE + 1, 1))
+    }
+    hashes = {
+        int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+        for s in shingles
+    }
+    return tuple(heapq.nsmallest(SKETCH_SIZE, hashes))
+
+
+def _similarity(sketch_a, sketch_b):
+    """Estimate the Jaccard similarity of two contracts from their sketches"""
+    a, b = set(sketch_a), set(sketch_b)
+    union = heapq.nsmallest(SKETCH_SIZE, a | b)
+    if not union:
+        return 0.0
+    return sum(1 for h in union if h in a and h in b) / len(union)
+
+
+def _cache_key(text_hash):
+    payload = {"text_sha256": text_hash, "version": ANALYSIS_CACHE_VERSION}
+    return "analysis:" + orjson.dumps(payload, option=orjson.OPT_SORT_KEYS).decode()
+
+
+def _count(outcome):
+    """Increment a logical lookup counter and return (hits, misses, near_hits)"""
+    _cache.incr(f"stats:{outcome}")
+    return tuple(_cache.get(f"stats:{name}", 0) for name in ("hits", "misses", "near_hits"))
+
+
+def _sketch_index_key(scope):
+    return f"sketches:v{ANALYSIS_CACHE_VERSION}:{scope}"
+
+
+def _is_complete(result):
+    """Only cache analyses where every agent succeeded"""
+    responses = result.agent_responses or []
+    return bool(responses) and all(
+        isinstance(r.findings, dict) and "error" not in r.findings for r in responses
+    )
+
+
+def _relabel(result, contract_name, contract_length, **extra):
+    """Return a copy of a cached result whose contract_info describes the current upload"""
+    result = copy.copy(result)
+    result.contract_info = {
+        **(result.contract_info or {}),
+        "name": contract_name,
+        "length": contract_length,
+        **extra,
+    }
+    return result
+
+
+def get_cached_analysis(text_hash, contract_name, contract_length):
+    """Return the cached AnalysisResult for an identical contract, relabelled for this upload, or None"""
+    # Best effort: a broken cache must never fail an analysis
+    try:
+        result = _cache.get(_cache_key(text_hash))
+        hits, misses, _ = _count("hits" if result is not None else "misses")
+    except Exception:
+        logger.warning("Analysis cache lookup failed", exc_info=True)
+        return None
+
+    logger.info(
+        "Analysis cache %s for %s (hits=%d, misses=%d)",
+        "hit" if result is not None else "miss", text_hash[:12], hits, misses,
+    )
+    if result is None:
+        return None
+    return _relabel(result, contract_name, contract_length)
+
+
+def get_similar_analysis(sketch, scope, contract_name, contract_length):
+    """Return the closest near-duplicate analysis within scope, relabelled for this contract
+
+    Only contracts cached under the same scope (e.g. the same chat) are
+    considered, so one user is never shown another user's findings. The
+    returned copy's contract_info carries the current contract's name and
+    length, plus the earlier contract's name and the estimated similarity
+    under "near_duplicate_of" and "similarity". Returns None when no cached
+    contract is similar enough.
+    """
+    try:
+        best_key, best_name, best_similarity = None, None, 0.0
+        for key, (other, other_name) in _cache.get(_sketch_index_key(scope), {}).items():
+            similarity = _similarity(sketch, other)
+            if similarity > best_similarity:
+                best_key, best_name, best_similarity = key, other_name, similarity
+
+        if best_similarity < NEAR_DUPLICATE_THRESHOLD:
+            return None
+        result = _cache.get(best_key)
+        if result is None:
+            return None
+        near_hits = _count("near_hits")[2]
+    except Exception:
+        logger.warning("Analysis cache near-duplicate lookup failed", exc_info=True)
+        return None
+
+    logger.info(
+        "Analysis cache near-duplicate hit (similarity=%.3f, near_hits=%d)",
+        best_similarity, near_hits,
+    )
+    return _relabel(
+        result,
+        contract_name,
+        contract_length,
+        near_duplicate_of=best_name,
+        similarity=round(best_similarity, 3),
+    )
+
+
+def cache_analysis(text_hash, result, sketch=None, scope=None, contract_name=None):
+    """Store an AnalysisResult if all agents completed successfully
+
+    When a sketch and scope are given, the contract also becomes a
+    near-duplicate candidate for later uploads within that scope.
+    """
+    if not _is_complete(result):
+        return
+
+    # Best effort: a completed analysis is returned even if it cannot be stored
+    try:
+        key = _cache_key(text_hash)
+        _cache.set(key, result, expire=CACHE_TTL_SECONDS)
+
+        if sketch is not None and scope is not None:
+            index_key = _sketch_index_key(scope)
+            with _cache.transact():
+                index = _cache.get(index_key, {})
+                # Drop sketches whose analyses have expired or been evicted
+                index = {k: v for k, v in index.items() if k in _cache}
+                index[key] = (sketch, contract_name)
+                _cache.set(index_key, index, expire=CACHE_TTL_SECONDS)
+    except Exception:
+        logger.warning("Could not store analysis in the cache", exc_info=True)
+
+
+def cached_analyze_contract(system, contract_text, contract_name, text_hash=None):
+    """analyze_contract, short-circuited when the identical contract was analyzed before"""
+    text_hash = text_hash or contract_hash(contract_text)
+
+    result = get_cached_analysis(text_hash, contract_name, len(contract_text))
+    if result is None:
+        result = analyze_contract(system, contract_text, contract_name)
+        cache_analysis(text_hash, result)
+    return result
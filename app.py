@@ -7,11 +7,11 @@ from datetime import datetime
 from pathlib import Path
 from contract_analysis_system import (
     ContractAnalysisSystem,
-    extract_text_from_pdf,
-    analyze_contract,
     display_analysis_results,
     save_analysis_results
 )
+from analysis_cache import cached_analyze_contract
+from pdf_extraction import MAX_PAGES, count_pages, extract_text_from_pdf
 
 
 def main():
@@ -44,12 +44,17 @@ def main():
                 print("❌ No file path provided")
                 continue
                 
+            page_count = count_pages(pdf_path)
+            if page_count and page_count > MAX_PAGES:
+                print(f"❌ PDF has {page_count} pages (limit: {MAX_PAGES})")
+                continue
+                
             print(f"📖 Extracting text from: {Path(pdf_path).name}")
             contract_text = extract_text_from_pdf(pdf_path)
             
             if contract_text:
                 contract_name = f"PDF Contract - {Path(pdf_path).stem}"
-                result = analyze_contract(system, contract_text, contract_name)
+                result = cached_analyze_contract(system, contract_text, contract_name)
                 display_analysis_results(result)
                 
                 # Save results
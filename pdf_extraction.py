@@ -0,0 +1,176 @@
+"""
+PDF text extraction for the Contract Analysis Multi-Agent System
+"""
+
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+
+logger = logging.getLogger(__name__)
+
+# Longer documents are rejected before extraction to bound latency and memory
+MAX_PAGES = 100
+
+# The sample agreement repeated to 96 pages extracts in 0.20 s in a single
+# pass versus 0.24 s (warm) / 1.03 s (cold) through the process pool, so
+# documents up to MAX_PAGES are always extracted in-process. Larger ones,
+# only reachable by calling the extractor directly, get one worker per
+# PAGES_PER_WORKER pages.
+PAGES_PER_WORKER = 16
+
+# Shared worker pool, created on first use. "spawn" avoids forking a process
+# that already runs other threads (event loop executors, HTTP clients).
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _executor
+
+
+def _discard_executor(executor):
+    """Drop a broken pool so the next large PDF starts a fresh one"""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _pdfium_page_range(source, start, stop):
+    """Extract text from pages [start, stop) in a document opened by this process"""
+    pdf = pdfium.PdfDocument(source)
+    try:
+        return [pdf[i].get_textpage().get_text_range() for i in range(start, stop)]
+    finally:
+        pdf.close()
+
+
+def _extract_with_pdfium(source):
+    """Extract text with pypdfium2 (PDFium C++ engine)"""
+    pdf = pdfium.PdfDocument(source)
+    try:
+        page_count = len(pdf)
+        workers = 1
+        if page_count > MAX_PAGES:
+            workers = min(os.cpu_count() or 1, page_count // PAGES_PER_WORKER)
+        if workers < 2:
+            return "\n".join(page.get_textpage().get_text_range() for page in pdf)
+    finally:
+        pdf.close()
+
+    # PDFium is not thread-safe, so each worker process opens its own copy
+    # of the document and extracts one contiguous slice of pages.
+    step = -(-page_count // workers)
+    bounds = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+    executor = _get_executor()
+    try:
+        chunks = list(executor.map(partial(_pdfium_page_range, source), *zip(*bounds)))
+    except BrokenProcessPool:
+        logger.warning("PDF worker pool is broken; extracting in-process", exc_info=True)
+        _discard_executor(executor)
+        return "\n".join(_pdfium_page_range(source, 0, page_count))
+    return "\n".join(text for chunk in chunks for text in chunk)
+
+
+def _extract_with_pymupdf(source):
+    """Extract text with PyMuPDF"""
+    if isinstance(source, bytes):
+        doc = fitz.open(stream=source, filetype="pdf")
+    else:
+        doc = fitz.open(source)
+    # Pins the current get_text("text") default, which already leaves out image blocks
+    with doc:
+        return "\n".join(page.get_text("text", flags=fitz.TEXTFLAGS_TEXT) for page in doc)
+
+
+def _extract_with_pdftotext(source):
+    """Extract text with the poppler `pdftotext` command line tool"""
+    if isinstance(source, bytes):
+        # "-" as the input file makes pdftotext read the PDF from stdin
+        args, stdin = ["-"], source
+    else:
+        args, stdin = [str(source)], None
+    completed = subprocess.run(
+        ["pdftotext", "-layout", *args, "-"],
+        input=stdin,
+        capture_output=True,
+        check=True,
+    )
+    return completed.stdout.decode("utf-8", errors="replace")
+
+
+def _available_backends():
+    """Yield (name, extractor) pairs, fastest first"""
+    if pdfium is not None:
+        yield "pypdfium2", _extract_with_pdfium
+    if fitz is not None:
+        yield "PyMuPDF", _extract_with_pymupdf
+    if shutil.which("pdftotext"):
+        yield "pdftotext", _extract_with_pdftotext
+
+
+def count_pages(source):
+    """Return the page count of a PDF path or PDF bytes, or None if it cannot be read"""
+    try:
+        if pdfium is not None:
+            pdf = pdfium.PdfDocument(source)
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
+        if fitz is not None:
+            if isinstance(source, bytes):
+                doc = fitz.open(stream=source, filetype="pdf")
+            else:
+                doc = fitz.open(source)
+            with doc:
+                return doc.page_count
+    except Exception:
+        logger.warning("Could not read the page count of the PDF", exc_info=True)
+    return None
+
+
+def _extract_text(source, label):
+    """Try each available backend in turn on a PDF path or PDF bytes"""
+    for name, extractor in _available_backends():
+        try:
+            return extractor(source)
+        except Exception:
+            logger.warning("%s could not extract text from %s", name, label, exc_info=True)
+
+    logger.error("No PDF backend could extract text from %s", label)
+    return ""
+
+
+def extract_text_from_pdf(pdf_path):
+    """Extract all text from a PDF file, returning an empty string on failure"""
+    return _extract_text(pdf_path, pdf_path)
+
+
+def extract_text_from_bytes(data):
+    """Extract all text from an in-memory PDF, returning an empty string on failure"""
+    return _extract_text(bytes(data), f"<{len(data)} bytes>")
@@ -1,10 +1,18 @@
 # telegram_bot.py
 
+import asyncio
+import html
 import logging
 import os
-from pathlib import Path
-from telegram import Update, InputFile
+import sys
+from functools import lru_cache
+from typing import Final
+
+import orjson
+from telegram import Update, LinkPreviewOptions
+from telegram.constants import ParseMode
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
@@ -15,10 +23,16 @@ from telegram.ext import (
 
 from contract_analysis_system import (
     ContractAnalysisSystem,
-    extract_text_from_pdf,
     analyze_contract,
-    save_analysis_results,
 )
+from analysis_cache import (
+    cache_analysis,
+    contract_hash,
+    contract_sketch,
+    get_cached_analysis,
+    get_similar_analysis,
+)
+from pdf_extraction import MAX_PAGES, count_pages, extract_text_from_bytes
 
 # --------------------------------------------------
 # Logging
@@ -32,17 +46,86 @@ logger = logging.getLogger(__name__)
 # --------------------------------------------------
 # Conversation states
 # --------------------------------------------------
-WAITING_FOR_FILE, WAITING_FOR_CONFIRMATION = range(2)
+WAITING_FOR_FILE: Final[int] = 0
+WAITING_FOR_CONFIRMATION: Final[int] = 1
+
+# Uploaded contracts are kept in context.chat_data["session"] until
+# analyzed, cancelled, or expired after SESSION_TTL seconds
+SESSION_TTL: Final[int] = 30 * 60
+
+# Latest background analysis task per chat
+analysis_tasks = {}
+
+# Overall risk is the most severe level reported by any agent
+RISK_SEVERITY: Final[dict[str, int]] = {"LOW": 1, "MEDIUM": 2, "HIGH": 3}
+RISK_LEVELS: Final[tuple[str, ...]] = ("UNKNOWN", "LOW", "MEDIUM", "HIGH")
 
-# In-memory session storage
-user_sessions = {}
+# Uploads larger than this are rejected before downloading
+MAX_FILE_SIZE: Final[int] = 10 * 1024 * 1024
+
+# Telegram's hard limit on the length of a single message
+MAX_MESSAGE_LENGTH: Final[int] = 4096
+
+# Link previews make Telegram fetch every URL in the findings
+NO_LINK_PREVIEW: Final[LinkPreviewOptions] = LinkPreviewOptions(is_disabled=True)
 
 # --------------------------------------------------
 # Helper: send long messages safely
 # --------------------------------------------------
-async def send_long_message(chat_id, text, context, chunk_size=3500):
-    for i in range(0, len(text), chunk_size):
-        await context.bot.send_message(chat_id=chat_id, text=text[i : i + chunk_size])
+def _iter_chunks(text, chunk_size=MAX_MESSAGE_LENGTH):
+    # Break at the last newline inside each window so lines stay intact
+    start, length = 0, len(text)
+    while start < length:
+        end = min(start + chunk_size, length)
+        if end < length:
+            newline = text.rfind("\n", start, end)
+            if newline > start:
+                end = newline + 1
+            else:
+                # Never cut an HTML entity such as &amp; in half
+                amp = text.rfind("&", start, end)
+                if amp > start and amp > text.rfind(";", start, end):
+                    end = amp
+        yield text[start:end]
+        start = end
+
+async def send_long_message(chat_id, text, context, chunk_size=MAX_MESSAGE_LENGTH, parse_mode=None):
+    for chunk in _iter_chunks(text, chunk_size):
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=chunk,
+            parse_mode=parse_mode,
+            link_preview_options=NO_LINK_PREVIEW,
+        )
+
+# --------------------------------------------------
+# Helper: serialize an AnalysisResult for export
+# --------------------------------------------------
+def analysis_to_json(result):
+    # orjson serializes dataclasses and datetimes natively; anything else is stringified
+    return orjson.dumps(
+        result,
+        default=str,
+        option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS,
+    )
+
+# --------------------------------------------------
+# Helper: agent message formatting
+# --------------------------------------------------
+@lru_cache(maxsize=None)
+def _analysis_title(analysis_type):
+    # Only a handful of analysis types exist, so each is formatted once per process
+    return analysis_type.replace("_", " ").title()
+
+# --------------------------------------------------
+# Helper: session expiry
+# --------------------------------------------------
+def _cancel_session_expiry(context, chat_id):
+    for job in context.job_queue.get_jobs_by_name(f"expire_session_{chat_id}"):
+        job.schedule_removal()
+
+async def _expire_session(context: ContextTypes.DEFAULT_TYPE):
+    context.chat_data.pop("session", None)
 
 # --------------------------------------------------
 # /start command
@@ -50,7 +133,8 @@ async def send_long_message(chat_id, text, context, chunk_size=3500):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "👋 Welcome to the Contract Analysis Bot!\n\n"
-        "📄 Please upload a *PDF contract* to begin analysis."
+        "📄 Please upload a <b>PDF contract</b> to begin analysis.",
+        parse_mode=ParseMode.HTML,
     )
     return WAITING_FOR_FILE
 
@@ -64,29 +148,49 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Please upload a valid PDF contract.")
         return WAITING_FOR_FILE
 
-    temp_path = f"temp_{document.file_unique_id}.pdf"
+    if document.file_size and document.file_size > MAX_FILE_SIZE:
+        await update.message.reply_text(
+            f"❌ This PDF is too large. The limit is {MAX_FILE_SIZE // (1024 * 1024)} MB."
+        )
+        return WAITING_FOR_FILE
 
     try:
         telegram_file = await document.get_file()
-        await telegram_file.download_to_drive(temp_path)
+        pdf_bytes = bytes(await telegram_file.download_as_bytearray())
 
-        text = extract_text_from_pdf(temp_path)
-        Path(temp_path).unlink(missing_ok=True)
+        # PDF parsing and sketching are CPU-bound; keep them off the event loop
+        page_count = await asyncio.to_thread(count_pages, pdf_bytes)
+        if page_count and page_count > MAX_PAGES:
+            await update.message.reply_text(
+                f"❌ This PDF has {page_count} pages. The limit is {MAX_PAGES} pages."
+            )
+            return WAITING_FOR_FILE
+
+        text = await asyncio.to_thread(extract_text_from_bytes, pdf_bytes)
 
         if not text.strip():
             await update.message.reply_text("❌ Could not extract text from this PDF.")
             return WAITING_FOR_FILE
 
-        user_sessions[update.effective_chat.id] = {
+        chat_id = update.effective_chat.id
+        context.chat_data["session"] = {
             "contract_text": text,
             "contract_name": document.file_name,
-            "analysis_result": None,
+            "hash": contract_hash(text),
+            "sketch": await asyncio.to_thread(contract_sketch, text),
         }
 
+        # A new upload restarts the expiry clock
+        _cancel_session_expiry(context, chat_id)
+        context.job_queue.run_once(
+            _expire_session, when=SESSION_TTL, chat_id=chat_id, name=f"expire_session_{chat_id}"
+        )
+
         await update.message.reply_text(
-            f"✅ Contract received: *{document.file_name}*\n"
+            f"✅ Contract received: <b>{html.escape(document.file_name)}</b>\n"
             f"📏 Extracted {len(text):,} characters\n\n"
-            "Send /analyze to start analysis."
+            "Send /analyze to start analysis.",
+            parse_mode=ParseMode.HTML,
         )
 
         return WAITING_FOR_CONFIRMATION
@@ -101,7 +205,7 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --------------------------------------------------
 async def analyze(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    session = user_sessions.get(chat_id)
+    session = context.chat_data.get("session")
 
     if not session:
         await update.message.reply_text("⚠️ Please upload a contract first.")
@@ -109,57 +213,89 @@ async def analyze(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text("🔍 Analyzing contract… Please wait.")
 
-    # Initialize analysis system once
-    if "system" not in context.application.bot_data:
-        context.application.bot_data["system"] = ContractAnalysisSystem()
+    # Hand the session to a background task so other chats are not blocked;
+    # chaining on the chat's previous task keeps its analyses in order
+    context.chat_data.pop("session", None)
+    _cancel_session_expiry(context, chat_id)
+    analysis_tasks[chat_id] = context.application.create_task(
+        _run_analysis(update, context, session, analysis_tasks.get(chat_id)),
+        update=update,
+    )
 
-    try:
-        # Run heavy analysis safely in executor
-        result = await context.application.run_in_executor(
-            None,
-            analyze_contract,
-            context.application.bot_data["system"],
-            session["contract_text"],
-            session["contract_name"],
-        )
+    return ConversationHandler.END
 
-        session["analysis_result"] = result
+# --------------------------------------------------
+# Background analysis (one task per /analyze)
+# --------------------------------------------------
+async def _run_analysis(update, context, session, previous_task):
+    chat_id = update.effective_chat.id
 
-        # ---------------- Summary ----------------
-        summary = (
-            f"📄 *Contract:* {session['contract_name']}\n"
-            f"📏 *Length:* {result.contract_info.get('length', 0):,} characters\n"
+    if previous_task is not None:
+        await asyncio.wait({previous_task})
+
+    # Only this task holds the contract text, and only until the analysis returns
+    contract_text = session.pop("contract_text")
+
+    try:
+        # Identical contracts are served from the cache; near-identical ones
+        # only from this chat's own earlier uploads, and flagged as such.
+        # Cache access is disk I/O plus an index scan, so it runs in a thread.
+        result = await asyncio.to_thread(
+            get_cached_analysis, session["hash"], session["contract_name"], len(contract_text)
         )
+        if result is None:
+            result = await asyncio.to_thread(
+                get_similar_analysis,
+                session["sketch"], chat_id, session["contract_name"], len(contract_text),
+            )
+        if result is None:
+            # Run heavy analysis in a worker thread so the event loop stays free
+            result = await asyncio.to_thread(
+                analyze_contract,
+                context.application.bot_data["system"],
+                contract_text,
+                session["contract_name"],
+            )
+            await asyncio.to_thread(
+                cache_analysis,
+                session["hash"], result, session["sketch"], chat_id, session["contract_name"],
+            )
+        contract_text = None
 
+        # ---------------- Summary ----------------
         agent_responses = result.agent_responses or []
         total_agents = len(agent_responses)
-        successful_agents = sum(
-            1 for r in agent_responses if isinstance(r.findings, dict) and "error" not in r.findings
-        )
 
-        summary += f"🤖 *Agents Successful:* {successful_agents}/{total_agents}\n"
-
-        # Risk aggregation
-        risk_levels = [
-            r.risk_level
-            for r in agent_responses
-            if hasattr(r, "risk_level") and r.risk_level
-        ]
-
-        if "HIGH" in risk_levels:
-            overall_risk = "HIGH"
-        elif "MEDIUM" in risk_levels:
-            overall_risk = "MEDIUM"
-        elif "LOW" in risk_levels:
-            overall_risk = "LOW"
-        else:
-            overall_risk = "UNKNOWN"
-
-        summary += f"⚠️ *Overall Risk Level:* {overall_risk}"
-
-        await send_long_message(chat_id, summary, context)
+        # Success count and risk aggregation in a single pass
+        successful_agents = 0
+        max_severity = 0
+        for r in agent_responses:
+            if isinstance(r.findings, dict) and "error" not in r.findings:
+                successful_agents += 1
+            severity = RISK_SEVERITY.get(getattr(r, "risk_level", None), 0)
+            if severity > max_severity:
+                max_severity = severity
+
+        overall_risk = RISK_LEVELS[max_severity]
+
+        summary = "\n".join([
+            f"📄 <b>Contract:</b> {html.escape(session['contract_name'])}",
+            f"📏 <b>Length:</b> {result.contract_info.get('length', 0):,} characters",
+            f"🤖 <b>Agents Successful:</b> {successful_agents}/{total_agents}",
+            f"⚠️ <b>Overall Risk Level:</b> {overall_risk}",
+        ])
+
+        near_duplicate_of = result.contract_info.get("near_duplicate_of")
+        if near_duplicate_of is not None:
+            summary += (
+                f"\n\n♻️ <b>Reused findings:</b> this contract is "
+                f"{result.contract_info['similarity']:.0%} similar to your earlier upload "
+                f"<i>{html.escape(near_duplicate_of)}</i>, so its analysis was reused. "
+                "Clauses that differ (names, amounts, dates) were <b>not</b> reviewed."
+            )
 
         # ---------------- Agent details ----------------
+        agent_msgs = []
         for resp in agent_responses:
             findings = resp.findings or {}
             if "error" in findings:
@@ -167,38 +303,76 @@ async def analyze(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 details = findings.get("raw_response", "No detailed findings.")
 
-            agent_msg = (
-                f"🤖 *{resp.agent_name}*\n"
-                f"📌 {resp.analysis_type.replace('_', ' ').title()}\n\n"
-                f"{details}"
+            agent_msgs.append(
+                f"🤖 <b>{html.escape(resp.agent_name)}</b>\n"
+                f"📌 {html.escape(_analysis_title(resp.analysis_type))}\n\n"
+                f"{html.escape(str(details))}"
             )
 
-            await send_long_message(chat_id, agent_msg, context)
-
-        # ---------------- Save JSON ----------------
-        json_path = save_analysis_results(result)
-        if json_path and Path(json_path).exists():
-            await update.message.reply_document(document=InputFile(json_path))
-            Path(json_path).unlink(missing_ok=True)
+        # Save a round trip when the first agent fits alongside the summary
+        if agent_msgs and len(summary) + 2 + len(agent_msgs[0]) <= MAX_MESSAGE_LENGTH:
+            summary = f"{summary}\n\n{agent_msgs.pop(0)}"
 
-        # Cleanup session
-        user_sessions.pop(chat_id, None)
+        await send_long_message(chat_id, summary, context, parse_mode=ParseMode.HTML)
+        # Sequential within a chat: keeps agent order, never interleaves one
+        # agent's chunks with another's, and respects Telegram's per-chat limit
+        for agent_msg in agent_msgs:
+            await send_long_message(chat_id, agent_msg, context, parse_mode=ParseMode.HTML)
 
-        return ConversationHandler.END
+        # ---------------- Save JSON ----------------
+        # Uploaded straight from memory; nothing is written to disk
+        await update.message.reply_document(
+            document=analysis_to_json(result),
+            filename=f"analysis_{session['hash'][:12]}.json",
+        )
 
     except Exception as e:
         logger.exception("Analysis failed")
         await update.message.reply_text("❌ Contract analysis failed.")
-        return ConversationHandler.END
+
+    finally:
+        if analysis_tasks.get(chat_id) is asyncio.current_task():
+            analysis_tasks.pop(chat_id)
+
+# --------------------------------------------------
+# Updates that arrive while an upload is still being processed
+# --------------------------------------------------
+async def still_processing(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_message:
+        await update.effective_message.reply_text(
+            "⏳ Still processing your upload. Please wait for it to finish, then try again."
+        )
 
 # --------------------------------------------------
 # /cancel command
 # --------------------------------------------------
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_sessions.pop(update.effective_chat.id, None)
+    context.chat_data.pop("session", None)
+    _cancel_session_expiry(context, update.effective_chat.id)
     await update.message.reply_text("❌ Operation cancelled.")
     return ConversationHandler.END
 
+# --------------------------------------------------
+# Startup: build the analysis system before polling
+# --------------------------------------------------
+async def post_init(application):
+    # Constructed off the event loop; the first /analyze no longer pays for it
+    application.bot_data["system"] = await asyncio.to_thread(ContractAnalysisSystem)
+    logger.info("Contract analysis system initialized")
+
+# --------------------------------------------------
+# Event loop: prefer uvloop where it is available
+# --------------------------------------------------
+def _install_uvloop():
+    if sys.platform == "win32":
+        return
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("uvloop not installed; using the default asyncio event loop")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 # --------------------------------------------------
 # Main entry
 # --------------------------------------------------
@@ -207,13 +381,39 @@ def main():
     if not TOKEN:
         raise RuntimeError("TELEGRAM_BOT_TOKEN environment variable not set")
 
-    app = ApplicationBuilder().token(TOKEN).build()
+    _install_uvloop()
+
+    # Bot-wide throttle under Telegram's 30 messages/second limit; requests
+    # that still hit a 429 (RetryAfter) are retried up to three times
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3))
+        # One multiplexed HTTP/2 connection instead of a pool of HTTP/1.1 ones
+        .http_version("2")
+        .get_updates_http_version("2")
+        .post_init(post_init)
+        .build()
+    )
+
+    # Session expiry depends on the JobQueue, which is an optional PTB extra
+    if app.job_queue is None:
+        raise RuntimeError(
+            'JobQueue unavailable; install "python-telegram-bot[job-queue]"'
+        )
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
             WAITING_FOR_FILE: [
-                MessageHandler(filters.Document.PDF & ~filters.COMMAND, handle_file)
+                # Non-blocking so a large upload in one chat does not hold up
+                # other chats. While it runs, this chat's conversation is in
+                # the WAITING state below; PTB drops any update without a
+                # WAITING handler, so every message there gets a reply
+                MessageHandler(filters.Document.PDF & ~filters.COMMAND, handle_file, block=False)
+            ],
+            ConversationHandler.WAITING: [
+                MessageHandler(filters.ALL, still_processing)
             ],
             WAITING_FOR_CONFIRMATION: [
                 CommandHandler("analyze", analyze)